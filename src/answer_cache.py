@@ -0,0 +1,152 @@
+import collections
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIMILARITY_THRESHOLD = 0.6  # Dice similarity of character trigrams needed for a hit on a seeded question.
+CACHE_MAX_ENTRIES = 256  # least recently used answers are evicted above this.
+CACHE_TTL_SEC = 3600  # [sec]. lifetime of learned answers, seeded ones never expire.
+CACHE_MIN_WORDS = 4  # shorter utterances ("John", "yes please") are too ambiguous to learn from.
+# Words that carry no meaning of their own, everything else (including "not", "sunday") is a content word
+STOP_WORDS = frozenset("a an the is are am was were be been do does did can could would will should shall may might "
+                       "have has had i you we they he she it me my your our their us them what when where who whom "
+                       "whose why how which there here this that these those to of on in at for with about from by "
+                       "and or please just so then also any some get".split())
+# Leading words of utterances that are worth learning an answer for
+QUESTION_WORDS = frozenset("what when where who whom whose why how which is are am was were do does did can could "
+                           "would will should shall may might have has".split())
+
+
+def normalize(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def trigrams(text: str) -> frozenset:
+    padded = f" {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def similarity(a: str, b: str) -> float:
+    """
+    Dice similarity of the character trigrams of two normalized texts, from 0 to 1.
+    """
+    a, b = trigrams(normalize(a)), trigrams(normalize(b))
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def content_words(text: str) -> frozenset:
+    """
+    Normalized content words, plural "s" stripped ("hours" -> "hour").
+    """
+    return frozenset(word[:-1] if len(word) > 3 and word.endswith("s") else word
+                     for word in normalize(text).split() if word not in STOP_WORDS)
+
+
+def is_question(text: str) -> bool:
+    """
+    Cheap test for question-like utterances: a question mark or a leading question word.
+    """
+    words = normalize(text).split()
+    return text.rstrip().endswith("?") or (bool(words) and words[0] in QUESTION_WORDS)
+
+
+def parse_faq(prompt: str) -> list:
+    """
+    Extracts (question, answer) pairs from the "Commonly Asked Questions" section of a prompt.
+    """
+    match = re.search(r"Commonly Asked Questions:(.*?)(?:\n\s*\n|\Z)", prompt, re.S)
+    if not match:
+        return []
+    lines = [line.strip() for line in match.group(1).splitlines() if line.strip()]
+    return [(question, answer) for question, answer in zip(lines, lines[1:])
+            if question.endswith("?") and not answer.endswith("?")]
+
+
+class AnswerCache:
+    """
+    Local answer cache keyed on normalized transcripts.
+
+    Pinned (seeded FAQ) entries also match near-misses, found through an inverted character-trigram index
+    so a lookup only scores entries sharing at least one trigram with the question. Trigrams can't tell
+    an extra or negating word from a rephrasing, so a near-miss also needs every content word of the
+    question in the FAQ question ("is there a service fee to cancel" doesn't match "... to come out").
+    Learned entries only match their exact normalized question, since a reply learned in one context
+    ("Thanks John, ...") is wrong for a similar-looking utterance. They expire after `ttl` and are
+    evicted least recently used first.
+    """
+    def __init__(self, threshold: float = CACHE_SIMILARITY_THRESHOLD, max_entries: int = CACHE_MAX_ENTRIES,
+                 ttl: float = CACHE_TTL_SEC):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (answer, trigrams, expires at or None)
+        self.index = collections.defaultdict(set)
+        self.content = {}  # key -> content words, pinned entries only
+        self.hits = 0
+        self.misses = 0
+
+    def seed(self, pairs):
+        for question, answer in pairs:
+            self.put(question, answer, pinned=True)
+
+    def put(self, question: str, answer: str, pinned: bool = False):
+        key = normalize(question)
+        if not key:
+            return
+        if key in self.entries:
+            if self.entries[key][2] is None and not pinned:
+                # Learned answers never replace seeded ones
+                return
+            self._remove(key)
+        expires = None if pinned else time.monotonic() + self.ttl
+        grams = trigrams(key) if pinned else frozenset()
+        self.entries[key] = (answer, grams, expires)
+        if pinned:
+            self.content[key] = content_words(key)
+        for gram in grams:
+            self.index[gram].add(key)
+        while len(self.entries) > self.max_entries:
+            oldest = next((k for k, entry in self.entries.items() if entry[2] is not None), None)
+            if oldest is None:
+                break
+            self._remove(oldest)
+
+    def lookup(self, question: str):
+        """
+        Returns the answer of the exact question, else of the most similar seeded question above the
+        threshold, or None.
+        """
+        key = normalize(question)
+        if key not in self.entries:
+            grams = trigrams(key)
+            words = content_words(key)
+            overlap = collections.Counter()
+            for gram in grams:
+                overlap.update(self.index.get(gram, ()))
+            key, best = None, self.threshold
+            for candidate, shared in overlap.items():
+                score = 2 * shared / (len(grams) + len(self.entries[candidate][1]))
+                if score >= best and words and words <= self.content[candidate]:
+                    key, best = candidate, score
+
+        if key is not None:
+            answer, _, expires = self.entries[key]
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return answer
+        self.misses += 1
+        return None
+
+    def _remove(self, key: str):
+        _, grams, _ = self.entries.pop(key)
+        self.content.pop(key, None)
+        for gram in grams:
+            keys = self.index[gram]
+            keys.discard(key)
+            if not keys:
+                del self.index[gram]
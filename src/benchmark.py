@@ -0,0 +1,234 @@
+"""
+Headless replay benchmark: no microphone, display or API keys needed.
+
+A WAV file is replayed into one or more engine sessions, Deepgram is replaced by a local websocket
+that replays a scripted transcript and OpenAI by a local mock completion server. Prints throughput
+and latency percentiles as JSON.
+
+    python -m src.benchmark call.wav --script call.json --speed 4 --repeat 5 --sessions 20
+
+The script is a JSON list of {"start": sec, "end": sec, "text": "..."} in seconds of audio received by
+the stand-in. VAD is off by default so those match the WAV file.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import time
+import urllib.parse
+
+import openai
+import websockets
+from aiohttp import web
+
+from src import engine as engine_config
+from src import pipeline
+from src.engine import EventSink, FileAudioSource, SessionEngine, load_wav
+from src.latency import LatencyLog
+from src.llm_pool import LLM_CONCURRENCY, LLM_MAX_CONCURRENCY, LLM_QUEUE_SIZE
+
+MOCK_ANSWER = ("Sure, we can help with that. A technician can come out on the next business day and the "
+               "diagnostic fee is just seventy nine dollars. Could I get your name and address please?")
+
+
+def deepgram_result(segment: dict, is_final: bool) -> str:
+    words = segment["text"].split()
+    text = segment["text"] if is_final else " ".join(words[:max(1, len(words) // 2)])
+    return json.dumps({
+        "type": "Results",
+        "channel_index": [pipeline.CALLER_CHANNEL if pipeline.MULTICHANNEL else 0, pipeline.CHANNELS],
+        "start": segment["start"],
+        "duration": segment["end"] - segment["start"],
+        "is_final": is_final,
+        "speech_final": is_final,
+        "channel": {"alternatives": [{"transcript": text, "confidence": 1.0, "words": []}]},
+    })
+
+
+async def deepgram_stand_in(ws, script, delay_sec, bytes_per_sec):
+    """
+    Replays the script on one connection: an interim result once half of a segment's audio has arrived
+    and the final one once all of it has, each after `delay_sec` of simulated processing.
+    """
+    async def send_later(message):
+        await asyncio.sleep(delay_sec)
+        try:
+            await ws.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    received = 0.0
+    interims = sorted(script, key=lambda segment: (segment["start"] + segment["end"]) / 2)
+    finals = sorted(script, key=lambda segment: segment["end"])
+    async for message in ws:
+        if isinstance(message, str):
+            # KeepAlive and other control messages
+            continue
+        received += len(message) / bytes_per_sec
+        while interims and (interims[0]["start"] + interims[0]["end"]) / 2 <= received:
+            asyncio.create_task(send_later(deepgram_result(interims.pop(0), is_final=False)))
+        while finals and finals[0]["end"] <= received:
+            asyncio.create_task(send_later(deepgram_result(finals.pop(0), is_final=True)))
+
+
+def mock_completion_app(first_token_sec: float, token_sec: float, answer: str = MOCK_ANSWER) -> web.Application:
+    """
+    Minimal stand-in for the OpenAI chat completions endpoint, streaming or not.
+    """
+    tokens = [f"{word} " for word in answer.split()]
+
+    def chunk(delta: dict, finish_reason=None) -> bytes:
+        body = {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": "mock",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(body)}\n\n".encode()
+
+    async def completions(request):
+        body = await request.json()
+        await asyncio.sleep(first_token_sec)
+        if not body.get("stream"):
+            await asyncio.sleep(token_sec * (len(tokens) - 1))
+            return web.json_response({
+                "id": "mock", "object": "chat.completion", "created": 0, "model": "mock",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        try:
+            await response.prepare(request)
+            for i, token in enumerate(tokens):
+                if i:
+                    await asyncio.sleep(token_sec)
+                await response.write(chunk({"content": token}))
+            await response.write(chunk({}, finish_reason="stop"))
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # Cancelled answers, e.g. a speculation the caller's final words didn't match
+            pass
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    return app
+
+
+class BenchmarkSink(EventSink):
+    """
+    Counts what a session shows. Answers count as rendered when they are emitted.
+    """
+    def __init__(self):
+        self.transcripts = 0
+        self.answers = 0
+        self.cancelled = 0
+
+    def emit(self, event, value):
+        if event == "-TRANSCRIPT-":
+            self.transcripts += 1
+        elif event == "-LLM_ANSWER-":
+            self.answers += 1
+        elif event == "-LLM_CANCELLED-":
+            self.cancelled += 1
+
+
+async def run_benchmark(args) -> dict:
+    bytes_per_sec = pipeline.RATE * pipeline.SAMPLE_WIDTH * pipeline.CHANNELS
+    audio_sec = len(load_wav(args.wav)) / bytes_per_sec
+    with open(args.script) as f:
+        segments = json.load(f)
+    script = [{**segment, "start": segment["start"] + i * audio_sec, "end": segment["end"] + i * audio_sec}
+              for i in range(args.repeat) for segment in segments]
+
+    pipeline.VAD_ENABLED = args.vad
+    pipeline.SEND_BATCH_MS = args.batch_ms
+    pipeline.STANDBY_CONNECTION = False
+    engine_config.ANSWER_CACHE = not args.no_cache
+    engine_config.SPECULATIVE_ANSWERS = args.speculation
+
+    # Local Deepgram stand-in
+    deepgram = await websockets.serve(
+        functools.partial(deepgram_stand_in, script=script, delay_sec=args.deepgram_delay_ms / 1000,
+                          bytes_per_sec=bytes_per_sec),
+        "127.0.0.1", 0,
+    )
+    query = urllib.parse.urlsplit(pipeline.WS_URL).query
+    pipeline.WS_URL = f"ws://127.0.0.1:{deepgram.sockets[0].getsockname()[1]}/v1/listen?{query}"
+
+    # Local OpenAI stand-in
+    runner = web.AppRunner(mock_completion_app(args.first_token_ms / 1000, args.token_ms / 1000))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    openai.api_base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/v1"
+    openai.api_key = "benchmark"
+
+    expected = len(script) * args.sessions
+    latency_log = LatencyLog(path=args.timelines, summary_every=max(expected, 1))
+    engine = SessionEngine(concurrency=args.concurrency, queue_size=args.queue_size, latency_log=latency_log,
+                           max_concurrency=args.max_concurrency)
+    engine_task = asyncio.create_task(engine.run())
+
+    started = time.monotonic()
+    sinks = [BenchmarkSink() for _ in range(args.sessions)]
+    sessions = [await engine.open_session(sink, FileAudioSource(args.wav, args.speed, args.frame_ms, args.repeat))
+                for sink in sinks]
+    await asyncio.gather(*(session.source_task for session in sessions))
+    deadline = time.monotonic() + args.drain_sec
+    while sum(sink.answers for sink in sinks) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    wall_sec = time.monotonic() - started
+
+    cache_hits = sum(session.answer_cache.hits for session in sessions if session.answer_cache)
+    speculation = [session.speculator for session in sessions if session.speculator]
+    engine_task.cancel()
+    await asyncio.gather(engine_task, return_exceptions=True)
+    deepgram.close()
+    await deepgram.wait_closed()
+    await runner.cleanup()
+    latency_log.close()
+
+    answers = sum(sink.answers for sink in sinks)
+    return {
+        "sessions": args.sessions,
+        "audio_sec": round(audio_sec * args.repeat * args.sessions, 2),
+        "wall_sec": round(wall_sec, 2),
+        "realtime_factor": round(audio_sec * args.repeat * args.sessions / wall_sec, 2),
+        "transcripts": sum(sink.transcripts for sink in sinks),
+        "answers": answers,
+        "unanswered": max(expected - answers, 0),
+        "cancelled": sum(sink.cancelled for sink in sinks),
+        "cache_hits": cache_hits,
+        "speculation_hits": sum(speculator.hits for speculator in speculation),
+        "speculation_misses": sum(speculator.misses for speculator in speculation),
+        "speculation_restarts": sum(speculator.restarts for speculator in speculation),
+        "answers_per_sec": round(answers / wall_sec, 2),
+        "latency_ms": latency_log.summary(),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("wav", help="audio file to replay")
+    parser.add_argument("--script", required=True, help="JSON transcript script for the Deepgram stand-in")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 = as fast as possible")
+    parser.add_argument("--repeat", type=int, default=1, help="times the file is replayed back to back")
+    parser.add_argument("--sessions", type=int, default=1, help="concurrent calls replaying the file")
+    parser.add_argument("--frame-ms", type=int, default=pipeline.FRAME_MS)
+    parser.add_argument("--batch-ms", type=int, default=pipeline.SEND_BATCH_MS)
+    parser.add_argument("--vad", action="store_true", help="gate audio with the VAD (shifts script timing)")
+    parser.add_argument("--no-cache", action="store_true", help="send every question to the LLM")
+    parser.add_argument("--speculation", action="store_true", help="also answer from interim transcripts")
+    parser.add_argument("--concurrency", type=int, default=LLM_CONCURRENCY, help="answers in flight per session")
+    parser.add_argument("--queue-size", type=int, default=LLM_QUEUE_SIZE, help="answers waiting per session")
+    parser.add_argument("--max-concurrency", type=int, default=LLM_MAX_CONCURRENCY, help="answers in flight in total")
+    parser.add_argument("--deepgram-delay-ms", type=float, default=150)
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=15)
+    parser.add_argument("--drain-sec", type=float, default=10, help="wait for pending answers after the audio")
+    parser.add_argument("--timelines", default="benchmark_latency.jsonl")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(args.log_level)
+    print(json.dumps(asyncio.run(run_benchmark(args)), indent=2))
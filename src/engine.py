@@ -0,0 +1,520 @@
+"""
+Headless session engine: many concurrent calls on one asyncio loop.
+
+Every session has its own audio queue, Deepgram connection, history, answer cache and speculation, all
+sessions share one LLMWorkerPool (and so one pooled OpenAI HTTP client) and one LatencyLog. Results go
+to an EventSink, the GUI is just one of them. Audio comes from PyAudio, WAV files or TCP sockets.
+
+    python -m src.engine call1.wav call2.wav --speed 1
+    python -m src.engine --listen 127.0.0.1:8765
+
+Sockets carry raw int16 PCM at pipeline.RATE with pipeline.CHANNELS channels, one call per connection.
+Events are printed as JSON lines.
+"""
+import abc
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+import soundfile
+
+from src.answer_cache import CACHE_MIN_WORDS, AnswerCache, is_question, parse_faq
+from src.history import ConversationHistory
+from src.latency import LatencyLog, LatencyTracker
+from src.llm_pool import LLM_CONCURRENCY, LLM_CONNECTION_LIMIT, LLM_MAX_CONCURRENCY, LLM_QUEUE_SIZE, LLMWorkerPool
+from src.pipeline import (CALLER_CHANNEL, CHANNELS, FRAME_MS, RATE, SAMPLE_WIDTH, LoopAudioQueue, gen_llm_answer,
+                          summarize_history, websocket_handler)
+from src.prompts import SYSTEM_PROMPT
+from src.speculation import Speculator
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE = True  # answer FAQ and repeated questions locally, the LLM only sees misses
+VERIFY_CACHED_ANSWERS = False  # still ask the LLM in the background and refresh the cache with its answer
+# Start answering from interim transcripts before the caller finishes. Costs extra LLM requests: every
+# time the interim text drifts the running speculation is cancelled and re-issued.
+SPECULATIVE_ANSWERS = False
+LATENCY_TRACKING = True
+
+SOCKET_HOST = "127.0.0.1"
+SOCKET_PORT = 8765
+
+
+class EventSink(abc.ABC):
+    """
+    Receives the events of one session, on the engine's loop thread:
+    "-TRANSCRIPT-" text, "-LLM_DELTA-" (answer id, delta), "-LLM_ANSWER-" (answer id, text)
+    and "-LLM_CANCELLED-" answer id for a partial answer that was superseded.
+
+    Sinks with `confirms_render` call Session.confirm_render() once they have actually shown an answer,
+    otherwise the answer counts as rendered when it is emitted.
+    """
+    confirms_render = False
+
+    @abc.abstractmethod
+    def emit(self, event: str, value):
+        pass
+
+
+class WindowSink(EventSink):
+    """
+    Forwards events to a PySimpleGUI window, which reads them on the GUI thread.
+    """
+    confirms_render = True
+
+    def __init__(self, window):
+        self.window = window
+
+    def emit(self, event: str, value):
+        self.window.write_event_value(event, value)
+
+
+class CallbackSink(EventSink):
+    """
+    Calls `callback(event, value)` for every event. It runs on the loop thread and must not block.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, event: str, value):
+        self.callback(event, value)
+
+
+class Session:
+    """
+    One call: its Deepgram connection and the answer orchestration the GUI used to do.
+
+    The pipeline reports to the session through write_event_value(), the session decides what gets
+    answered, from where (cache, speculation or the LLM) and what is shown, and tells its sink.
+    Everything but confirm_render() runs on the engine's loop thread.
+    """
+    def __init__(self, engine, session_id, sink: EventSink, audio_queue=None):
+        self.engine = engine
+        self.session_id = session_id
+        self.sink = sink
+        self.loop = asyncio.get_running_loop()
+        self.audio_queue = audio_queue if audio_queue is not None else LoopAudioQueue(self.loop)
+        self.tracker = LatencyTracker(engine.latency_log) if engine.latency_log else None
+        self.history = ConversationHistory(summarize_history)
+        self.answer_cache = AnswerCache() if ANSWER_CACHE else None
+        if self.answer_cache:
+            self.answer_cache.seed(parse_faq(SYSTEM_PROMPT))
+        # Answers started from interim transcripts, hidden until the final utterance confirms them
+        self.speculator = Speculator() if SPECULATIVE_ANSWERS else None
+        self.speculative = {}
+        self.adopted = set()
+
+        self.answer_ids = itertools.count()
+        # Answers the sink is showing while they are generated
+        self.visible = set()
+        # Question of every answer still expected, and the cached answers being checked against the LLM
+        self.questions = {}
+        self.verifying = {}
+        # Latency timeline of every answer still expected, and of finished ones the sink hasn't shown yet
+        self.timelines = {}
+        self.awaiting_render = {}
+        self.tasks = []
+        self.source_task = None
+        self.closed = False
+
+    def start(self, source=None):
+        self.tasks.append(asyncio.create_task(self.run()))
+        if source is not None:
+            self.source_task = asyncio.create_task(source.run(self.audio_queue, self.tracker))
+            self.tasks.append(self.source_task)
+
+    async def run(self):
+        await websocket_handler(self.audio_queue, self, self.tracker, interim=self.speculator is not None)
+
+    async def close(self):
+        self.closed = True
+        for answer_id in list(self.questions):
+            self.engine.llm_pool.cancel((self.session_id, answer_id))
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def write_event_value(self, event: str, value):
+        if self.closed:
+            return
+        if event == "-TRANSCRIPT-":
+            self.sink.emit(event, value)
+        elif event == "-INTERIM-":
+            self._on_interim(value)
+        elif event == "-UTTERANCE-":
+            self._on_utterance(*value)
+        elif event == "-LLM_DELTA-":
+            self._on_delta(*value)
+        elif event == "-LLM_ANSWER-":
+            self._on_answer(*value)
+
+    def confirm_render(self, answer_id, stage: str, stamp: float = None):
+        """
+        Called by the sink, from any thread, once the first text ("first_render") or the whole answer
+        ("rendered") is on screen.
+        """
+        self.loop.call_soon_threadsafe(self._confirm_render, answer_id, stage, stamp or time.monotonic())
+
+    def _confirm_render(self, answer_id, stage, stamp):
+        if stage == "first_render":
+            if answer_id in self.timelines:
+                self.timelines[answer_id].setdefault("first_render", stamp)
+        elif answer_id in self.awaiting_render:
+            timeline, info = self.awaiting_render.pop(answer_id)
+            timeline.setdefault("first_render", stamp)
+            timeline["rendered"] = stamp
+            self.tracker.record(timeline, **info)
+
+    def _submit_answer(self, answer_id, question, context, timeline=None, **kwargs):
+        self.questions[answer_id] = question
+        if timeline is not None:
+            self.timelines[answer_id] = timeline
+        job = functools.partial(gen_llm_answer, question, self, context, answer_id=answer_id, timeline=timeline,
+                                **kwargs)
+        self.engine.llm_pool.submit((self.session_id, answer_id), job, group=self.session_id, on_drop=self._on_drop)
+
+    def _on_drop(self, job_id):
+        # The pool dropped the job unstarted, no answer will come for it
+        self._cancel_answer(job_id[1])
+
+    def _cancel_answer(self, answer_id):
+        self.engine.llm_pool.cancel((self.session_id, answer_id))
+        if self.speculator and self.speculator.answer_id == answer_id:
+            self.speculator.discard()
+        self.questions.pop(answer_id, None)
+        self.verifying.pop(answer_id, None)
+        self.speculative.pop(answer_id, None)
+        self.adopted.discard(answer_id)
+        self.timelines.pop(answer_id, None)
+        if answer_id in self.visible:
+            self.visible.discard(answer_id)
+            self.sink.emit("-LLM_CANCELLED-", answer_id)
+
+    def _show_delta(self, answer_id, delta):
+        self.sink.emit("-LLM_DELTA-", (answer_id, delta))
+        if answer_id in self.timelines and not self.sink.confirms_render:
+            self.timelines[answer_id].setdefault("first_render", time.monotonic())
+
+    def _finish_answer(self, answer_id, question, answer, timeline=None, source="llm"):
+        self.history.add("AI", answer)
+        self.sink.emit("-LLM_ANSWER-", (answer_id, answer))
+        if self.tracker and timeline is not None:
+            info = {"session": self.session_id, "source": source, "words": len(question.split())}
+            if self.sink.confirms_render:
+                self.awaiting_render[answer_id] = (timeline, info)
+            else:
+                self.tracker.record(timeline, **info)
+        if self.answer_cache and len(question.split()) >= CACHE_MIN_WORDS and is_question(question):
+            self.answer_cache.put(question, answer)
+
+    def _on_interim(self, interim):
+        # The caller is still speaking, answer what has been said so far in the background
+        if not self.speculator.should_start(interim):
+            return
+        answer_id = next(self.answer_ids)
+        replaced_id = self.speculator.start(answer_id, interim)
+        if replaced_id is not None:
+            self._cancel_answer(replaced_id)
+        self.speculative[answer_id] = {"text": "", "final": None}
+        self._submit_answer(answer_id, interim, self.history.render(), timeline={})
+
+    def _on_utterance(self, utterance, timeline):
+        # A new utterance supersedes whatever is still being answered
+        for stale_id in list(self.visible):
+            self._cancel_answer(stale_id)
+
+        context = self.history.render()
+        self.history.add("USER", utterance)
+        cached_answer = self.answer_cache.lookup(utterance) if self.answer_cache else None
+        if cached_answer is not None:
+            logger.debug(f"Session {self.session_id} answered from cache: {utterance}")
+            stale_id = self.speculator.discard() if self.speculator else None
+            if stale_id is not None:
+                self._cancel_answer(stale_id)
+            self._finish_answer(next(self.answer_ids), utterance, cached_answer, timeline, source="cache")
+            if VERIFY_CACHED_ANSWERS:
+                answer_id = next(self.answer_ids)
+                self.verifying[answer_id] = cached_answer
+                self._submit_answer(answer_id, utterance, context, stream=False)
+            return
+
+        answer_id, matched = self.speculator.resolve(utterance) if self.speculator else (None, False)
+        if matched:
+            # Show the speculative answer, it may already be complete
+            guess = self.speculative.pop(answer_id)
+            # The speculative timeline already holds the LLM stamps, add the audio side
+            self.timelines[answer_id].update(timeline)
+            if guess["final"] is None:
+                self.questions[answer_id] = utterance
+                self.visible.add(answer_id)
+                self.adopted.add(answer_id)
+                if guess["text"]:
+                    self._show_delta(answer_id, guess["text"])
+            else:
+                self.questions.pop(answer_id)
+                self._finish_answer(answer_id, utterance, guess["final"], self.timelines.pop(answer_id),
+                                    source="speculative")
+        else:
+            if answer_id is not None:
+                self._cancel_answer(answer_id)
+            answer_id = next(self.answer_ids)
+            self.visible.add(answer_id)
+            self._submit_answer(answer_id, utterance, context, timeline=timeline)
+
+    def _on_delta(self, answer_id, delta):
+        if answer_id in self.visible:
+            self._show_delta(answer_id, delta)
+        elif answer_id in self.speculative:
+            self.speculative[answer_id]["text"] += delta
+
+    def _on_answer(self, answer_id, answer):
+        # Only the final text goes to the history
+        if answer_id in self.speculative:
+            self.speculative[answer_id]["final"] = answer
+        elif answer_id in self.verifying:
+            question = self.questions.pop(answer_id)
+            if self.verifying.pop(answer_id) != answer:
+                logger.info(f"Cached answer differs from the LLM for: {question}")
+            self.answer_cache.put(question, answer)
+        elif answer_id not in self.visible:
+            logger.debug(f"Discarding superseded answer {answer_id} of session {self.session_id}.")
+        else:
+            self.visible.discard(answer_id)
+            source = "speculative" if answer_id in self.adopted else "llm"
+            self.adopted.discard(answer_id)
+            self._finish_answer(answer_id, self.questions.pop(answer_id), answer, self.timelines.pop(answer_id, None),
+                                source)
+
+
+class SessionEngine:
+    """
+    Runs sessions on one event loop with one shared LLMWorkerPool.
+
+    Every session may generate `concurrency` answers at a time with `queue_size` more waiting, the pool's
+    total grows with the number of sessions up to `max_concurrency`, and so does its HTTP connection limit so
+    requests in flight never wait for a connection.
+
+    Either await run() inside an existing loop and use open_session()/close_session(), or start() the
+    engine on a loop of its own in a daemon thread and use the thread-safe add_session()/remove_session().
+    """
+    def __init__(self, concurrency: int = LLM_CONCURRENCY, queue_size: int = LLM_QUEUE_SIZE, latency_log=None,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY):
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.llm_pool = LLMWorkerPool(concurrency=concurrency, queue_size=queue_size, group_concurrency=concurrency,
+                                      connection_limit=max(LLM_CONNECTION_LIMIT, max_concurrency))
+        self.latency_log = latency_log
+        self.sessions = {}
+        self.session_ids = itertools.count()
+        self.loop = None
+        self._task = None
+        self._thread = None
+
+    async def run(self):
+        """
+        Runs the shared LLM workers until cancelled, then closes all sessions.
+        """
+        self.loop = asyncio.get_running_loop()
+        try:
+            await self.llm_pool.run()
+        finally:
+            for session_id in list(self.sessions):
+                await self.close_session(session_id)
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self._task = self.loop.create_task(self.run())
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self._task.cancel)
+            self._thread.join()
+            self._thread = None
+
+    async def open_session(self, sink: EventSink, source=None, audio_queue=None) -> Session:
+        """
+        Starts a session reporting to `sink`. Audio comes from `source` or is put into session.audio_queue
+        by the caller (e.g. an AudioRecorder), `audio_queue` replaces the default LoopAudioQueue.
+        """
+        session = Session(self, next(self.session_ids), sink, audio_queue)
+        self.sessions[session.session_id] = session
+        self._resize_pool()
+        session.start(source)
+        logger.info(f"Session {session.session_id} opened, {len(self.sessions)} active.")
+        return session
+
+    async def close_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            await session.close()
+            self._resize_pool()
+            logger.info(f"Session {session_id} closed, {len(self.sessions)} active.")
+
+    def _resize_pool(self):
+        self.llm_pool.resize(min(self.concurrency * max(len(self.sessions), 1), self.max_concurrency))
+
+    def add_session(self, sink: EventSink, source=None, audio_queue=None) -> Session:
+        return asyncio.run_coroutine_threadsafe(self.open_session(sink, source, audio_queue), self.loop).result()
+
+    def remove_session(self, session_id):
+        asyncio.run_coroutine_threadsafe(self.close_session(session_id), self.loop).result()
+
+
+def load_wav(path: str, rate: int = RATE, channels: int = CHANNELS) -> bytes:
+    """
+    Reads a WAV file as interleaved int16 PCM at `rate` with `channels` channels, resampling if needed.
+    Mono output mixes the file down; a file with too few channels is taken as the caller's side,
+    it goes to CALLER_CHANNEL and the other channels are silent.
+    """
+    data, file_rate = soundfile.read(path, dtype="float32", always_2d=True)
+    if channels == 1:
+        data = data.mean(axis=1, keepdims=True)
+    elif data.shape[1] < channels:
+        mixed = np.zeros((len(data), channels), dtype=np.float32)
+        mixed[:, CALLER_CHANNEL] = data.mean(axis=1)
+        data = mixed
+    else:
+        data = data[:, :channels]
+    if file_rate != rate:
+        positions = np.arange(0, len(data), file_rate / rate)
+        data = np.column_stack([np.interp(positions, np.arange(len(data)), column) for column in data.T])
+    return (np.clip(data, -1, 1) * 32767).astype(np.int16).tobytes()
+
+
+class FileAudioSource:
+    """
+    Replays a WAV file into a session frame by frame, `speed` times faster than real time (0 = no pacing).
+    """
+    def __init__(self, path: str, speed: float = 1.0, frame_ms: int = FRAME_MS, repeat: int = 1):
+        self.path = path
+        self.speed = speed
+        self.frame_ms = frame_ms
+        self.repeat = repeat
+
+    async def run(self, audio_queue, tracker=None):
+        audio = load_wav(self.path)
+        frame_bytes = RATE * self.frame_ms // 1000 * SAMPLE_WIDTH * CHANNELS
+        frame_sec = self.frame_ms / 1000
+        for _ in range(self.repeat):
+            started = time.monotonic()
+            for i, offset in enumerate(range(0, len(audio), frame_bytes)):
+                if self.speed:
+                    await asyncio.sleep(max(0.0, started + i * frame_sec / self.speed - time.monotonic()))
+                else:
+                    await asyncio.sleep(0)
+                frame = audio[offset:offset + frame_bytes]
+                if tracker:
+                    tracker.audio_captured(len(frame))
+                audio_queue.put(frame)
+
+
+class SocketAudioSource:
+    """
+    Reads raw int16 PCM from a stream reader into a session until the peer closes the connection.
+    """
+    def __init__(self, reader: asyncio.StreamReader, frame_ms: int = FRAME_MS):
+        self.reader = reader
+        self.frame_bytes = RATE * frame_ms // 1000 * SAMPLE_WIDTH * CHANNELS
+
+    async def run(self, audio_queue, tracker=None):
+        while True:
+            frame = await self.reader.read(self.frame_bytes)
+            if not frame:
+                break
+            if tracker:
+                tracker.audio_captured(len(frame))
+            audio_queue.put(frame)
+
+
+async def serve_audio_sockets(engine: SessionEngine, sink_factory, host: str = SOCKET_HOST,
+                              port: int = SOCKET_PORT) -> asyncio.AbstractServer:
+    """
+    Accepts one call per TCP connection. `sink_factory(peer)` creates the sink of each new session.
+    """
+    async def handle(reader, writer):
+        peer = "%s:%s" % writer.get_extra_info("peername")[:2]
+        session = await engine.open_session(sink_factory(peer), SocketAudioSource(reader))
+        try:
+            await session.source_task
+        finally:
+            writer.close()
+            await engine.close_session(session.session_id)
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def print_sink(name: str, deltas: bool = False) -> CallbackSink:
+    def callback(event, value):
+        if event != "-LLM_DELTA-" or deltas:
+            print(json.dumps({"source": name, "event": event.strip("-").lower(), "value": value}), flush=True)
+    return CallbackSink(callback)
+
+
+async def serve(args):
+    latency_log = LatencyLog() if LATENCY_TRACKING else None
+    engine = SessionEngine(args.concurrency, args.queue_size, latency_log, args.max_concurrency)
+    engine_task = asyncio.create_task(engine.run())
+    sources = []
+    for path in args.wav:
+        session = await engine.open_session(print_sink(path, args.deltas), FileAudioSource(path, args.speed))
+        sources.append(session.source_task)
+    try:
+        if args.listen:
+            host, _, port = args.listen.rpartition(":")
+            server = await serve_audio_sockets(engine, functools.partial(print_sink, deltas=args.deltas),
+                                               host or SOCKET_HOST, int(port))
+            logger.info(f"Listening for audio on {args.listen}.")
+            async with server:
+                await server.serve_forever()
+        else:
+            await asyncio.gather(*sources)
+            # Let the last answers finish
+            await asyncio.sleep(args.drain_sec)
+    finally:
+        engine_task.cancel()
+        await asyncio.gather(engine_task, return_exceptions=True)
+        if latency_log:
+            latency_log.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("wav", nargs="*", help="audio files to answer, one session each")
+    parser.add_argument("--listen", help="accept raw PCM calls on host:port")
+    parser.add_argument("--speed", type=float, default=1.0, help="file replay speed, 0 = as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=LLM_CONCURRENCY, help="answers in flight per session")
+    parser.add_argument("--queue-size", type=int, default=LLM_QUEUE_SIZE, help="answers waiting per session")
+    parser.add_argument("--max-concurrency", type=int, default=LLM_MAX_CONCURRENCY, help="answers in flight in total")
+    parser.add_argument("--deltas", action="store_true", help="also print partial answers")
+    parser.add_argument("--drain-sec", type=float, default=10, help="wait for pending answers after the files")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+    if not args.wav and not args.listen:
+        parser.error("give audio files and/or --listen")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
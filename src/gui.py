@@ -0,0 +1,61 @@
+SCROLLBACK_LINES = 1000  # lines kept in a pane, older ones are only kept in the export buffer.
+RENDER_INTERVAL_SEC = 0.1  # [sec]. panes are redrawn at least this often while events keep coming.
+
+
+class ScrollbackPane:
+    """
+    Append-only renderer for a PySimpleGUI Multiline.
+
+    append() commits text and set_live() replaces the trailing "live" text (answers still streaming in);
+    both only touch Python state. flush() sends Tk just what changed since the last flush, trims lines
+    beyond `max_lines` and is meant to be called once per frame. Committed text is kept for export().
+    """
+    def __init__(self, element, max_lines: int = SCROLLBACK_LINES):
+        self.widget = element.Widget
+        self.disabled = element.Disabled
+        self.autoscroll = element.Autoscroll
+        self.max_lines = max_lines
+        self.text = []
+        self.new_text = []
+        self.live = ""
+        self.live_rendered = ""
+
+    def append(self, text: str):
+        self.text.append(text)
+        self.new_text.append(text)
+
+    def set_live(self, text: str):
+        self.live = text
+
+    def export(self) -> str:
+        return "".join(self.text)
+
+    def flush(self):
+        if not self.new_text and self.live == self.live_rendered:
+            return
+        if self.disabled:
+            self.widget.configure(state="normal")
+
+        live_start = f"end-1c-{len(self.live_rendered)}c"
+        if not self.live.startswith(self.live_rendered):
+            self.widget.delete(live_start, "end-1c")
+            self.live_rendered = ""
+            live_start = "end-1c"
+        if self.new_text:
+            self.widget.insert(live_start, "".join(self.new_text))
+            self.new_text = []
+        if len(self.live) > len(self.live_rendered):
+            self.widget.insert("end", self.live[len(self.live_rendered):])
+            self.live_rendered = self.live
+
+        # Trim old lines, never into the live text
+        lines = int(self.widget.index("end-1c").split(".")[0])
+        live_line = int(self.widget.index(f"end-1c-{len(self.live_rendered)}c").split(".")[0])
+        trim_to = min(lines - self.max_lines + 1, live_line)
+        if trim_to > 1:
+            self.widget.delete("1.0", f"{trim_to}.0")
+
+        if self.disabled:
+            self.widget.configure(state="disabled")
+        if self.autoscroll:
+            self.widget.see("end")
@@ -0,0 +1,93 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TOKEN_BUDGET = 800  # [tokens]. history sent along with every question.
+HISTORY_RECENT_SHARE = 0.5  # part of the budget left to verbatim turns after a summarization.
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate (~4 characters per token for English), good enough for budgeting.
+    """
+    return len(text) // 4 + 1
+
+
+class ConversationHistory:
+    """
+    Conversation history with a fixed token budget.
+
+    The most recent turns are kept verbatim. Once they outgrow the budget the oldest ones are
+    folded into a running summary by `summarizer(summary, turns) -> str`, which runs in a
+    background thread so answering a question never waits for it.
+    """
+    def __init__(self, summarizer, token_budget: int = HISTORY_TOKEN_BUDGET,
+                 recent_share: float = HISTORY_RECENT_SHARE):
+        self.summarizer = summarizer
+        self.token_budget = token_budget
+        self.recent_budget = int(token_budget * recent_share)
+        self.summary = ""
+        self.turns = []  # [(role, text, tokens)]
+        self._lock = threading.Lock()
+        self._summarizing = False
+
+    def add(self, role: str, text: str):
+        with self._lock:
+            self.turns.append((role, text, estimate_tokens(f"{role}: {text}\n")))
+        self._maybe_summarize()
+
+    def render(self) -> str:
+        """
+        Returns the history for the prompt: the summary plus as many recent turns as fit the budget.
+        """
+        with self._lock:
+            budget = self.token_budget - estimate_tokens(self.summary)
+            lines = []
+            for role, text, tokens in reversed(self.turns):
+                if tokens > budget:
+                    break
+                budget -= tokens
+                lines.append(f"{role}: {text}")
+            summary = self.summary
+        lines.reverse()
+        if summary:
+            lines.insert(0, f"SUMMARY OF EARLIER CONVERSATION: {summary}")
+        return "\n".join(lines)
+
+    def _maybe_summarize(self):
+        with self._lock:
+            if self._summarizing:
+                return
+            total = sum(tokens for _, _, tokens in self.turns) + estimate_tokens(self.summary)
+            if total <= self.token_budget:
+                return
+            # Fold the oldest turns until the verbatim part fits its share, keep at least the last one
+            folded, kept = 0, total - estimate_tokens(self.summary)
+            while folded < len(self.turns) - 1 and kept > self.recent_budget:
+                kept -= self.turns[folded][2]
+                folded += 1
+            if not folded:
+                return
+            self._summarizing = True
+            summary = self.summary
+            turns = "\n".join(f"{role}: {text}" for role, text, _ in self.turns[:folded])
+        threading.Thread(target=self._summarize, args=(summary, turns, folded), daemon=True).start()
+
+    def _summarize(self, summary: str, turns: str, folded: int):
+        try:
+            new_summary = self.summarizer(summary, turns)
+        except Exception as error:
+            # The turns stay verbatim, render() keeps the prompt inside the budget meanwhile
+            logger.error(f"Can't summarize history: {error}")
+            with self._lock:
+                self._summarizing = False
+            return
+
+        with self._lock:
+            # Turns are only ever appended, so the folded ones are still at the front
+            del self.turns[:folded]
+            self.summary = new_summary.strip()
+            self._summarizing = False
+        logger.debug(f"History summarized, {folded} turns folded.")
+        self._maybe_summarize()
@@ -0,0 +1,151 @@
+import collections
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+LATENCY_LOG_FILE = "latency.jsonl"
+LATENCY_LOG_MAX_BYTES = 10 * 1024 * 1024
+LATENCY_LOG_BACKUPS = 3
+LATENCY_WINDOW = 500  # utterances the live percentiles are computed over.
+LATENCY_SUMMARY_EVERY = 10  # log the live summary every N utterances.
+
+# Pipeline stages in the order an utterance passes them
+STAGES = ("captured", "sent", "transcript", "utterance", "llm_request", "first_token", "last_token",
+          "first_render", "rendered")
+# Reported spans: name -> (from stage, to stage)
+SPANS = {
+    "end_to_end": ("captured", "rendered"),
+    "transcript": ("captured", "transcript"),
+    "endpointing": ("transcript", "utterance"),
+    "first_token": ("llm_request", "first_token"),
+    "answer": ("utterance", "rendered"),
+}
+
+
+class LatencyLog:
+    """
+    Collects finished timelines, possibly of many sessions.
+
+    They go to a rotating JSONL file from a background thread and feed the live p50/p95/p99 summary.
+    """
+    def __init__(self, path: str = LATENCY_LOG_FILE, window: int = LATENCY_WINDOW,
+                 summary_every: int = LATENCY_SUMMARY_EVERY):
+        self.spans = {name: collections.deque(maxlen=window) for name in SPANS}
+        self.summary_every = summary_every
+        self.recorded = 0
+
+        # File writes happen on the listener thread, record() only enqueues
+        self.file_logger = logging.getLogger(f"{__name__}.timelines")
+        self.file_logger.propagate = False
+        self.file_logger.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=LATENCY_LOG_MAX_BYTES,
+                                                       backupCount=LATENCY_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log_queue = queue.SimpleQueue()
+        self.file_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+        self.listener = logging.handlers.QueueListener(log_queue, handler)
+        self.listener.start()
+
+    def record(self, timeline: dict, **info):
+        timeline.setdefault("rendered", time.monotonic())
+        origin = min(timeline[stage] for stage in STAGES if stage in timeline)
+        entry = dict(info)
+        entry["stages_ms"] = {stage: round((timeline[stage] - origin) * 1000, 1)
+                              for stage in STAGES if stage in timeline}
+        for name, (start, end) in SPANS.items():
+            if start in timeline and end in timeline:
+                span = (timeline[end] - timeline[start]) * 1000
+                entry[f"{name}_ms"] = round(span, 1)
+                self.spans[name].append(span)
+        self.file_logger.info(json.dumps(entry))
+
+        self.recorded += 1
+        if self.recorded % self.summary_every == 0:
+            logger.info(f"Latency summary: {json.dumps(self.summary())}")
+
+    def summary(self) -> dict:
+        """
+        Live p50/p95/p99 in milliseconds for every span over the last `window` utterances.
+        """
+        rv = {}
+        for name, values in self.spans.items():
+            if values:
+                p50, p95, p99 = np.percentile(np.fromiter(values, dtype=float), [50, 95, 99]).round(1).tolist()
+                rv[name] = {"p50": p50, "p95": p95, "p99": p99, "n": len(values)}
+        return rv
+
+    def close(self):
+        self.listener.stop()
+
+
+class LatencyTracker:
+    """
+    Per-utterance latency timelines on the monotonic clock, for one audio stream.
+
+    Audio is matched to transcripts by position: capture stamps are counted in captured bytes, send
+    stamps in seconds of audio sent on the current connection, which is the timeline Deepgram reports
+    results on. Timelines are plain dicts of stage -> timestamp, finished ones go to the LatencyLog.
+    """
+    def __init__(self, log: LatencyLog = None):
+        self.log = log or LatencyLog()
+        self.captures = collections.deque()  # [(captured bytes so far, capture time)]
+        self.captured_bytes = 0
+        self.consumed_bytes = 0
+        self.last_capture = None
+        self.sends = collections.deque(maxlen=4096)  # [(stream end offset, capture time, send time)]
+        self.last_segment = {}
+
+    def audio_captured(self, n_bytes: int):
+        """
+        Called from the audio callback for every captured buffer.
+        """
+        self.captured_bytes += n_bytes
+        self.captures.append((self.captured_bytes, time.monotonic()))
+
+    def audio_consumed(self, n_bytes: int):
+        """
+        Called when the sender takes captured audio off the queue, whether it is sent or not.
+        """
+        self.consumed_bytes += n_bytes
+        while self.captures and self.captures[0][0] <= self.consumed_bytes:
+            self.last_capture = self.captures.popleft()[1]
+
+    def audio_sent(self, stream_end_sec: float):
+        """
+        Called after a send with the seconds of audio sent so far on the connection.
+        """
+        self.sends.append((stream_end_sec, self.last_capture, time.monotonic()))
+
+    def reset_stream(self):
+        """
+        A new connection starts a new stream timeline.
+        """
+        self.sends.clear()
+
+    def transcript_received(self, stream_end_sec: float):
+        """
+        Stamps a final transcript segment ending at stream_end_sec with the capture and send of its audio.
+        """
+        segment = {"transcript": time.monotonic()}
+        for sent_until, captured, sent in self.sends:
+            if sent_until >= stream_end_sec:
+                segment["captured"], segment["sent"] = captured, sent
+                break
+        self.last_segment = segment
+
+    def new_timeline(self) -> dict:
+        """
+        Starts the timeline of an utterance that just completed, from its last transcript segment.
+        """
+        timeline = {stage: stamp for stage, stamp in self.last_segment.items() if stamp is not None}
+        timeline["utterance"] = time.monotonic()
+        return timeline
+
+    def record(self, timeline: dict, **info):
+        self.log.record(timeline, **info)
@@ -0,0 +1,112 @@
+import asyncio
+import collections
+import logging
+
+import aiohttp
+import openai
+
+logger = logging.getLogger(__name__)
+
+LLM_CONCURRENCY = 3  # answers of one session generated at the same time.
+LLM_QUEUE_SIZE = 4  # answers of one session waiting for a free slot, its oldest is dropped when full.
+LLM_MAX_CONCURRENCY = 64  # answers generated at the same time across all sessions.
+LLM_CONNECTION_LIMIT = 64  # pooled HTTP connections to the OpenAI API.
+
+
+class LLMWorkerPool:
+    """
+    Runs answer jobs on the event loop with a bounded number of them in flight.
+
+    Jobs are `(job_id, coroutine factory)` pairs submitted for a group (one per session). Every group has
+    its own bounded queue that drops its oldest entry when full, groups take turns for free slots and run
+    at most `group_concurrency` jobs each, so a burst in one call can't crowd out the others. All requests
+    share one aiohttp session, so connections are reused.
+    submit(), cancel() and resize() must be called on the loop thread (e.g. via loop.call_soon_threadsafe).
+    """
+    def __init__(self, concurrency: int = LLM_CONCURRENCY, queue_size: int = LLM_QUEUE_SIZE,
+                 connection_limit: int = LLM_CONNECTION_LIMIT, group_concurrency: int = None):
+        self.concurrency = concurrency
+        self.group_concurrency = group_concurrency or concurrency
+        self.queue_size = queue_size
+        self.connection_limit = connection_limit
+        self.queues = collections.OrderedDict()  # group -> deque of (job_id, job, on_drop), in turn order
+        self.running = {}  # job_id -> task
+        self.group_running = collections.Counter()
+        self._wakeup = asyncio.Event()
+
+    async def run(self):
+        connector = aiohttp.TCPConnector(limit=self.connection_limit)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Tasks copy the current context, so every job below uses the shared session
+            openai.aiosession.set(session)
+            try:
+                while True:
+                    if not self._dispatch():
+                        self._wakeup.clear()
+                        await self._wakeup.wait()
+            finally:
+                for task in list(self.running.values()):
+                    task.cancel()
+
+    def submit(self, job_id, job, group=None, on_drop=None):
+        """
+        Queues a job. If the group's queue is full its oldest job is dropped and `on_drop(job_id)`
+        of that job is called.
+        """
+        queue = self.queues.setdefault(group, collections.deque())
+        if len(queue) >= self.queue_size:
+            dropped_id, _, dropped_callback = queue.popleft()
+            logger.warning(f"LLM queue of {group} full, dropped job {dropped_id}.")
+            if dropped_callback is not None:
+                dropped_callback(dropped_id)
+        queue.append((job_id, job, on_drop))
+        self._wakeup.set()
+
+    def cancel(self, job_id):
+        for group, queue in self.queues.items():
+            for queued in queue:
+                if queued[0] == job_id:
+                    queue.remove(queued)
+                    if not queue:
+                        del self.queues[group]
+                    return
+        task = self.running.get(job_id)
+        if task is not None:
+            task.cancel()
+
+    def resize(self, concurrency: int):
+        self.concurrency = concurrency
+        self._wakeup.set()
+
+    def _dispatch(self) -> bool:
+        """
+        Starts the next job of the first group in turn that may run one, returns whether one was started.
+        """
+        if len(self.running) >= self.concurrency:
+            return False
+        for group, queue in self.queues.items():
+            if self.group_running[group] < self.group_concurrency:
+                break
+        else:
+            return False
+        job_id, job, _ = queue.popleft()
+        # The group goes to the back of the line
+        del self.queues[group]
+        if queue:
+            self.queues[group] = queue
+        task = asyncio.create_task(job())
+        self.running[job_id] = task
+        self.group_running[group] += 1
+        task.add_done_callback(lambda task: self._finished(job_id, group, task))
+        return True
+
+    def _finished(self, job_id, group, task):
+        self.running.pop(job_id, None)
+        self.group_running[group] -= 1
+        if not self.group_running[group]:
+            del self.group_running[group]
+        if task.cancelled():
+            logger.debug(f"LLM job {job_id} cancelled.")
+        elif task.exception() is not None:
+            logger.error(f"LLM job {job_id} failed: {task.exception()}")
+        self._wakeup.set()
@@ -1,15 +1,14 @@
 import PySimpleGUI as sg
 import pyaudio
+import numpy as np
 import threading
-import websockets
-import json
 import logging
-import asyncio
-import time
 import queue
-import openai
-from src.constants import DEEPGRAM_API_KEY, OPENAI_API_KEY
-from src.prompts import SYSTEM_PROMPT
+import time
+from src.engine import LATENCY_TRACKING, SessionEngine, WindowSink
+from src.gui import RENDER_INTERVAL_SEC, ScrollbackPane
+from src.latency import LatencyLog
+from src.pipeline import CALLER_CHANNEL, CHANNELS, FRAME_MS, MULTICHANNEL, RATE
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -18,124 +17,19 @@ logger = logging.getLogger(__name__)
 # Audio configuration
 CHUNK = 8192
 FORMAT = pyaudio.paInt16
-CHANNELS = 1
-RATE = 16000
-
-# Deepgram WebSocket configuration
-WS_URL = "wss://api.deepgram.com/v1/listen?encoding=linear16&sample_rate=16000&channels=1"
-WS_HEADER = {"Authorization": f"Token {DEEPGRAM_API_KEY}"}
-
-# Keep-alive configuration
-KEEP_ALIVE_INTERVAL = 5  # seconds
-openai.api_key = OPENAI_API_KEY
-
 
-async def websocket_handler(audio_queue, window):
-    """
-    Handles the WebSocket connection to Deepgram, sending audio data and receiving transcriptions.
-    """
-    reconnect_delay = 1
-    while True:
-        try:
-            async with websockets.connect(WS_URL, extra_headers=WS_HEADER) as ws:
-                logger.info("Connected to Deepgram WebSocket.")
-                reconnect_delay = 1  # Reset reconnect delay on successful connection
-                state = {'last_audio_time': time.time()}
-
-                # Create tasks for sending audio, receiving messages, and keep-alive
-                send_task = asyncio.create_task(send_audio(ws, audio_queue, state))
-                receive_task = asyncio.create_task(receive_messages(ws, window))
-                keep_alive_task = asyncio.create_task(send_keep_alive(ws, state))
-
-                # Wait for any task to complete (e.g., due to an exception)
-                done, pending = await asyncio.wait(
-                    [send_task, receive_task, keep_alive_task],
-                    return_when=asyncio.FIRST_EXCEPTION
-                )
-
-                # Cancel all pending tasks
-                for task in pending:
-                    task.cancel()
-
-        except websockets.exceptions.InvalidStatusCode as e:
-            logger.error(f"Invalid status code: {e.status_code}")
-            await asyncio.sleep(reconnect_delay)
-            reconnect_delay = min(reconnect_delay * 2, 60)
-        except websockets.exceptions.WebSocketException as e:
-            logger.error(f"WebSocket exception: {e}")
-            await asyncio.sleep(reconnect_delay)
-            reconnect_delay = min(reconnect_delay * 2, 60)
-        except Exception as e:
-            logger.error(f"Unexpected exception: {e}")
-            await asyncio.sleep(reconnect_delay)
-            reconnect_delay = min(reconnect_delay * 2, 60)
-        else:
-            # If the connection closes normally, reset the reconnect delay
-            reconnect_delay = 1
-
-    logger.debug("WebSocket handler terminated.")
-
-
-async def send_audio(ws, audio_queue, state):
-    """
-    Sends audio data from the queue to the WebSocket.
-    """
-    while True:
-        audio_data = await asyncio.to_thread(audio_queue.get)
-        if audio_data is None:
-            logger.debug("Received stop signal for sending audio.")
-            break
-        try:
-            await ws.send(audio_data)
-            state['last_audio_time'] = time.time()
-            logger.debug("Sent audio data to Deepgram.")
-        except websockets.exceptions.WebSocketException as e:
-            logger.error(f"WebSocket exception while sending audio: {e}")
-            break
-
-
-async def receive_messages(ws, window):
-    """
-    Receives transcription messages from the WebSocket and updates the GUI.
-    """
-    while True:
-        try:
-            response = await ws.recv()
-            response_json = json.loads(response)
-            if 'channel' in response_json and 'alternatives' in response_json['channel']:
-                transcription = response_json['channel']['alternatives'][0]['transcript']
-                if transcription:
-                    window.write_event_value("-TRANSCRIPT-", transcription)
-                    logger.debug(f"Received transcription: {transcription}")
-        except websockets.exceptions.WebSocketException as e:
-            logger.error(f"WebSocket exception while receiving messages: {e}")
-            break
-        except Exception as e:
-            logger.error(f"Exception while receiving messages: {e}")
-            break
-
-
-async def send_keep_alive(ws, state, keep_alive_interval=KEEP_ALIVE_INTERVAL):
-    """
-    Sends keep-alive messages to maintain the WebSocket connection.
-    """
-    while True:
-        await asyncio.sleep(keep_alive_interval)
-        if time.time() - state['last_audio_time'] > keep_alive_interval:
-            try:
-                await ws.send(json.dumps({"type": "KeepAlive"}))
-                logger.debug("Sent keep-alive message.")
-            except websockets.exceptions.WebSocketException as e:
-                logger.error(f"WebSocket exception while sending keep-alive: {e}")
-                break
+# Low-latency capture: small frames handed straight to the event loop
+LOW_LATENCY_CAPTURE = True
 
 
 class AudioRecorder:
     """
     Handles audio recording using PyAudio and sends audio data to a queue.
     """
-    def __init__(self, audio_queue):
+    def __init__(self, audio_queue, frames_per_buffer=CHUNK, tracker=None):
         self.audio_queue = audio_queue
+        self.frames_per_buffer = frames_per_buffer
+        self.tracker = tracker
         self.p = None
         self.stream = None
         self.is_recording = False
@@ -150,7 +44,7 @@ class AudioRecorder:
                                       channels=CHANNELS,
                                       rate=RATE,
                                       input=True,
-                                      frames_per_buffer=CHUNK,
+                                      frames_per_buffer=self.frames_per_buffer,
                                       stream_callback=self.callback)
         except Exception as e:
             logger.error(f"Failed to open audio stream: {e}")
@@ -163,6 +57,8 @@ class AudioRecorder:
 
     def callback(self, in_data, frame_count, time_info, status):
         if self.is_recording:
+            if self.tracker:
+                self.tracker.audio_captured(len(in_data))
             self.audio_queue.put(in_data)
         return (None, pyaudio.paContinue)
 
@@ -183,37 +79,66 @@ class AudioRecorder:
         logger.debug("Audio recording stopped.")
 
 
-def start_event_loop(loop, audio_queue, window):
+class LoopbackRecorder:
     """
-    Starts the asyncio event loop.
+    Records the microphone and the system loopback (the other party of the call) with soundcard and
+    interleaves them into one CHANNELS-channel int16 stream, the loopback on CALLER_CHANNEL.
+    Drop-in replacement for AudioRecorder when MULTICHANNEL is on.
     """
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(websocket_handler(audio_queue, window))
-
-
-def gen_llm_answer(transcript: str, window, history: str, temperature: float = 0.7) -> str:
-    system_prompt = SYSTEM_PROMPT
-
-    if history:
-        system_prompt += f"\nconversation history: \n {history}"
+    def __init__(self, audio_queue, frames_per_buffer=CHUNK, tracker=None):
+        self.audio_queue = audio_queue
+        self.frames_per_buffer = frames_per_buffer
+        self.tracker = tracker
+        self.thread = None
+        self.is_recording = False
 
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            temperature=temperature,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": transcript},
-            ],
-        )
-    except Exception as error:
-        logger.error(f"Can't generate answer: {error}")
-        raise error
+    def start(self):
+        if self.is_recording:
+            logger.warning("Audio recording is already in progress.")
+            return
+        try:
+            # Imported here: its PulseAudio backend connects to the sound server on import, mono capture
+            # must keep working without one
+            import soundcard
+            microphone = soundcard.default_microphone()
+            loopback = soundcard.get_microphone(str(soundcard.default_speaker().name), include_loopback=True)
+        except Exception as e:
+            logger.error(f"Failed to find the microphone and loopback devices: {e}")
+            return
+        self.is_recording = True
+        self.thread = threading.Thread(target=self.record, args=(microphone, loopback), daemon=True)
+        self.thread.start()
+        logger.debug("Microphone and loopback recording started.")
 
-    rv = response["choices"][0]["message"]["content"]
-    window.write_event_value("-LLM_ANSWER-", rv)
+    def record(self, microphone, loopback):
+        try:
+            with microphone.recorder(samplerate=RATE, channels=1, blocksize=self.frames_per_buffer) as mic, \
+                    loopback.recorder(samplerate=RATE, channels=1, blocksize=self.frames_per_buffer) as other:
+                # Drop what one side buffered while the other was starting, so the channels line up
+                mic.flush()
+                other.flush()
+                recorders = [other if channel == CALLER_CHANNEL else mic for channel in range(CHANNELS)]
+                while self.is_recording:
+                    # (frames, 1) blocks side by side give the interleaved (frames, channels) layout
+                    frames = np.hstack([recorder.record(numframes=self.frames_per_buffer) for recorder in recorders])
+                    in_data = (np.clip(frames, -1, 1) * 32767).astype(np.int16).tobytes()
+                    if self.tracker:
+                        self.tracker.audio_captured(len(in_data))
+                    self.audio_queue.put(in_data)
+        except Exception as e:
+            logger.error(f"Loopback recording failed: {e}")
+            self.is_recording = False
 
-    return rv
+    def stop(self):
+        if self.thread is None:
+            logger.warning("Audio recording is not active.")
+            return
+        self.is_recording = False
+        self.thread.join()
+        self.thread = None
+        # Signal the WebSocket handler to stop by sending None
+        self.audio_queue.put(None)
+        logger.debug("Audio recording stopped.")
 
 
 def main():
@@ -224,41 +149,71 @@ def main():
         [sg.Text("Transcript:", font=("Helvetica", 16))],
         [sg.Multiline(size=(60, 10), key="-TRANSCRIPT-", disabled=True, autoscroll=True)],
         [sg.Multiline(size=(60, 10), key="-LLM_ANSWER-", disabled=True, autoscroll=True)],
-        [sg.Button("Exit")]
+        [sg.Button("Export"), sg.Button("Exit")]
     ]
 
     # Create the window
     window = sg.Window("Audio Transcription App", layout, finalize=True)
-
-    # Create the audio queue
-    audio_queue = queue.Queue()
-
-    # Create the AudioRecorder
-    recorder = AudioRecorder(audio_queue)
-
-    # Create the asyncio event loop
-    loop = asyncio.new_event_loop()
-
-    # Start the event loop in a separate daemon thread
-    loop_thread = threading.Thread(target=start_event_loop, args=(loop, audio_queue, window), daemon=True)
-    loop_thread.start()
-
-    # Initialize recording state and transcript
+    transcript_pane = ScrollbackPane(window["-TRANSCRIPT-"])
+    answer_pane = ScrollbackPane(window["-LLM_ANSWER-"])
+
+    # Start the session engine on its own event loop thread, the window is the session's sink
+    latency_log = LatencyLog() if LATENCY_TRACKING else None
+    engine = SessionEngine(latency_log=latency_log)
+    engine.start()
+    session = engine.add_session(WindowSink(window), audio_queue=None if LOW_LATENCY_CAPTURE else queue.Queue())
+
+    # Create the recorder feeding the session
+    if MULTICHANNEL:
+        recorder = LoopbackRecorder(session.audio_queue, frames_per_buffer=RATE * FRAME_MS // 1000,
+                                    tracker=session.tracker)
+    elif LOW_LATENCY_CAPTURE:
+        recorder = AudioRecorder(session.audio_queue, frames_per_buffer=RATE * FRAME_MS // 1000,
+                                 tracker=session.tracker)
+    else:
+        recorder = AudioRecorder(session.audio_queue, tracker=session.tracker)
+
+    # Initialize recording state
     recording = False
-    transcript = ""
-    llm_answer = ""
-
-    history = ""
-
+    # Answers still being generated, keyed by answer id so concurrent answers don't interleave
+    partial_answers = {}
+    # Answers shown for the first time / in full since the last redraw, confirmed to the session on flush
+    first_renders = []
+    rendered = []
+
+    def render_answers():
+        answer_pane.set_live("\n".join(text for text in partial_answers.values() if text))
+
+    def flush_panes():
+        transcript_pane.flush()
+        answer_pane.flush()
+        now = time.monotonic()
+        for answer_id in first_renders:
+            session.confirm_render(answer_id, "first_render", now)
+        first_renders.clear()
+        for answer_id in rendered:
+            session.confirm_render(answer_id, "rendered", now)
+        rendered.clear()
+
+    # Queued events are all handled before the panes are redrawn once
+    dirty = False
+    last_flush = time.monotonic()
     while True:
-        event, values = window.read(timeout=100)
+        event, values = window.read(timeout=0 if dirty else 100)
+        if dirty and (event == sg.TIMEOUT_KEY or time.monotonic() - last_flush > RENDER_INTERVAL_SEC):
+            flush_panes()
+            dirty = False
+            last_flush = time.monotonic()
+        dirty = dirty or event not in (sg.TIMEOUT_KEY, None)
+
         if event in (sg.WIN_CLOSED, "Exit"):
             logger.debug("Exit event triggered. Closing application.")
             if recording:
                 recorder.stop()
-            # Stop the asyncio event loop
-            loop.call_soon_threadsafe(loop.stop)
-            loop_thread.join()
+            # Stop the engine and its event loop
+            engine.stop()
+            if latency_log:
+                latency_log.close()
             break
 
         if event == "-RECORD-":
@@ -275,23 +230,38 @@ def main():
                 window["-RECORD-"].update("Start Recording")
                 logger.debug("Recording stopped via GUI.")
 
+        if event == "Export":
+            path = sg.popup_get_file("Export the conversation to", save_as=True, default_extension=".txt",
+                                     file_types=(("Text", "*.txt"),))
+            if path:
+                with open(path, "w") as f:
+                    f.write(f"TRANSCRIPT:\n{transcript_pane.export()}\nANSWERS:\n{answer_pane.export()}")
+                logger.debug(f"Conversation exported to {path}.")
+
         if event == "-TRANSCRIPT-":
             # Append new transcription to the existing transcript
             transcription = values["-TRANSCRIPT-"]
+            transcript_pane.append(transcription + "\n")
 
-            llm_thread = threading.Thread(target=gen_llm_answer, args=(transcription, window, history))
-            llm_thread.start()
+        if event == "-LLM_DELTA-":
+            # Show the partial answer while the rest is still being generated
+            answer_id, delta = values["-LLM_DELTA-"]
+            if answer_id not in partial_answers:
+                first_renders.append(answer_id)
+            partial_answers[answer_id] = partial_answers.get(answer_id, "") + delta
+            render_answers()
 
-            transcript += transcription + "\n"
-            window["-TRANSCRIPT-"].update(transcript)
-            history += f'USER: {transcription}'
+        if event == "-LLM_CANCELLED-":
+            # A new utterance superseded the answer
+            partial_answers.pop(values["-LLM_CANCELLED-"], None)
+            render_answers()
 
         if event == "-LLM_ANSWER-":
-            # Append new transcription to the existing transcript
-            generated_answer = values["-LLM_ANSWER-"]
-            history += f'AI: {generated_answer}'
-            llm_answer += generated_answer + "\n"
-            window["-LLM_ANSWER-"].update(llm_answer)
+            answer_id, generated_answer = values["-LLM_ANSWER-"]
+            partial_answers.pop(answer_id, None)
+            answer_pane.append(generated_answer + "\n")
+            render_answers()
+            rendered.append(answer_id)
 
     window.close()
 
@@ -0,0 +1,353 @@
+import asyncio
+import json
+import logging
+import queue
+import time
+
+import openai
+import websockets
+
+from src.constants import DEEPGRAM_API_KEY, OPENAI_API_KEY
+from src.prompts import SUMMARY_PROMPT, SYSTEM_PROMPT
+from src.reconnect import ReplayBuffer, StandbyConnection
+from src.utterance import UtteranceAggregator
+from src.vad import VoiceActivityDetector
+
+logger = logging.getLogger(__name__)
+
+# Multichannel capture: our microphone and the system loopback (the other party) over one connection
+MULTICHANNEL = False
+CALLER_CHANNEL = 1  # only speech on this channel is answered, the other one is our own side.
+SPEAKER_LABELS = ("Me", "Caller")  # transcript prefix per channel.
+
+# Audio configuration
+CHANNELS = 2 if MULTICHANNEL else 1
+RATE = 16000
+SAMPLE_WIDTH = 2  # [bytes]. int16 PCM.
+FRAME_MS = 20  # [ms]. capture frame size, 20-100 ms is sensible.
+SEND_BATCH_MS = 100  # [ms]. upper bound of queued-up frames merged into one websocket send.
+
+# Voice activity detection: silence is not sent, KeepAlive messages hold the connection instead
+VAD_ENABLED = True
+
+# Deepgram WebSocket configuration
+ENDPOINTING_MS = 300  # silence Deepgram waits for before flagging speech_final
+UTTERANCE_END_MS = 1000  # word gap after which Deepgram sends an UtteranceEnd message
+WS_URL = (
+    f"wss://api.deepgram.com/v1/listen?encoding=linear16&sample_rate={RATE}&channels={CHANNELS}"
+    f"&multichannel={str(MULTICHANNEL).lower()}"
+    f"&interim_results=true&endpointing={ENDPOINTING_MS}&utterance_end_ms={UTTERANCE_END_MS}"
+)
+WS_HEADER = {"Authorization": f"Token {DEEPGRAM_API_KEY}"}
+
+# Keep-alive configuration
+KEEP_ALIVE_INTERVAL = 5  # seconds
+
+# Reconnect configuration
+STANDBY_CONNECTION = False  # keep a pre-warmed spare connection for instant failover, a second stream per call
+
+# LLM configuration
+LLM_MODEL = "gpt-3.5-turbo"
+STREAM_ANSWERS = True  # push partial answers as tokens arrive
+openai.api_key = OPENAI_API_KEY
+
+
+async def open_deepgram():
+    """
+    Opens a new Deepgram WebSocket connection.
+    """
+    return await websockets.connect(WS_URL, extra_headers=WS_HEADER)
+
+
+async def websocket_handler(audio_queue, events, tracker=None, interim=False):
+    """
+    Handles the WebSocket connection to Deepgram, sending audio data and receiving transcriptions.
+    Audio Deepgram hasn't finalized yet is re-sent on the next connection after a drop.
+    Results go to `events.write_event_value(key, value)`, e.g. a PySimpleGUI window or a Session.
+    "-UTTERANCE-" events carry the utterance and its latency timeline so far; with `interim` the
+    text so far is also reported as "-INTERIM-" while the caller speaks.
+    """
+    def on_utterance(utterance):
+        events.write_event_value("-UTTERANCE-", (utterance, tracker.new_timeline() if tracker else {}))
+
+    reconnect_delay = 1
+    # Lives across reconnects so a drop mid-sentence doesn't split the utterance
+    aggregator = UtteranceAggregator(
+        on_utterance,
+        on_partial=(lambda text: events.write_event_value("-INTERIM-", text)) if interim else None,
+    )
+    vad = VoiceActivityDetector(RATE, CHANNELS) if VAD_ENABLED else None
+    replay = ReplayBuffer(RATE * SAMPLE_WIDTH * CHANNELS)
+    standby = StandbyConnection(open_deepgram, KEEP_ALIVE_INTERVAL) if STANDBY_CONNECTION else None
+    try:
+        while True:
+            try:
+                ws = await standby.take() if standby else None
+                if ws is None:
+                    ws = await open_deepgram()
+                else:
+                    logger.info("Switched to the standby Deepgram WebSocket.")
+                if standby:
+                    standby.warm()
+                tasks = []
+                try:
+                    logger.info("Connected to Deepgram WebSocket.")
+                    reconnect_delay = 1  # Reset reconnect delay on successful connection
+                    state = {'last_audio_time': time.time(), 'stream_bytes': 0}
+                    if tracker:
+                        tracker.reset_stream()
+
+                    # Re-send the audio the previous connection didn't finalize
+                    pending_audio = replay.take()
+                    for audio_data in pending_audio:
+                        replay.append(audio_data)
+                        await ws.send(audio_data)
+                        state['stream_bytes'] += len(audio_data)
+                    if pending_audio:
+                        logger.info(f"Replayed {len(pending_audio)} audio buffers after reconnect.")
+
+                    # Create tasks for sending audio, receiving messages, and keep-alive
+                    send_task = asyncio.create_task(send_audio(ws, audio_queue, state, vad=vad, replay=replay,
+                                                              tracker=tracker))
+                    receive_task = asyncio.create_task(receive_messages(ws, events, aggregator, replay=replay,
+                                                                        tracker=tracker))
+                    keep_alive_task = asyncio.create_task(send_keep_alive(ws, state))
+
+                    # The tasks re-raise connection errors, so a drop fails over right away, even while the
+                    # VAD holds back silence. send_audio returning after a stop signal keeps the connection.
+                    tasks = [send_task, receive_task, keep_alive_task]
+                    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                    for task in done:
+                        task.result()
+                finally:
+                    # Cancel all pending tasks, also when the handler itself is cancelled
+                    for task in tasks:
+                        task.cancel()
+                    await ws.close()
+
+            except websockets.exceptions.InvalidStatusCode as e:
+                logger.error(f"Invalid status code: {e.status_code}")
+            except websockets.exceptions.WebSocketException as e:
+                logger.error(f"WebSocket exception: {e}")
+            except Exception as e:
+                logger.error(f"Unexpected exception: {e}")
+            else:
+                # If the connection closes normally, reset the reconnect delay
+                reconnect_delay = 1
+                continue
+
+            if standby is not None and standby.ready:
+                # Fail over right away, the spare connection is already open
+                continue
+            await asyncio.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, 60)
+    finally:
+        # A pending silence flush must not report an utterance after the handler is gone
+        aggregator.close()
+        if standby:
+            await standby.close()
+
+
+async def next_audio(audio_queue):
+    """
+    Waits for the next audio buffer, only a plain queue.Queue needs a worker thread for that.
+    """
+    if isinstance(audio_queue, LoopAudioQueue):
+        return await audio_queue.get()
+    return await asyncio.to_thread(audio_queue.get)
+
+
+async def send_audio(ws, audio_queue, state, max_batch_bytes=None, vad=None, replay=None, tracker=None):
+    """
+    Sends audio data from the queue to the WebSocket.
+    Frames that queued up in the meantime are merged into one send (up to SEND_BATCH_MS by default),
+    it never waits for more audio. With a VAD only speech is sent, send_keep_alive covers the silent stretches.
+    """
+    if max_batch_bytes is None:
+        max_batch_bytes = SEND_BATCH_MS * RATE // 1000 * SAMPLE_WIDTH * CHANNELS
+    stop = False
+    while not stop:
+        audio_data = await next_audio(audio_queue)
+        if audio_data is None:
+            logger.debug("Received stop signal for sending audio.")
+            break
+        batch = [audio_data]
+        batch_bytes = len(audio_data)
+        while batch_bytes < max_batch_bytes:
+            try:
+                frame = audio_queue.get_nowait()
+            except (asyncio.QueueEmpty, queue.Empty):
+                break
+            if frame is None:
+                stop = True
+                break
+            batch.append(frame)
+            batch_bytes += len(frame)
+        payload = b"".join(batch) if len(batch) > 1 else audio_data
+        if tracker:
+            tracker.audio_consumed(batch_bytes)
+        if vad is not None:
+            was_speaking = vad.in_speech
+            payload = vad.process(payload)
+            if was_speaking and not vad.in_speech:
+                logger.debug(f"Speech ended, {vad.dropped_bytes / (RATE * SAMPLE_WIDTH * CHANNELS):.1f} sec of "
+                             f"silence not sent so far.")
+        try:
+            if payload:
+                if replay is not None:
+                    # Buffered before sending so a failed send is replayed on the next connection
+                    replay.append(payload)
+                await ws.send(payload)
+                state['last_audio_time'] = time.time()
+                state['stream_bytes'] += len(payload)
+                if tracker:
+                    tracker.audio_sent(state['stream_bytes'] / (RATE * SAMPLE_WIDTH * CHANNELS))
+                logger.debug(f"Sent {len(batch)} audio buffers to Deepgram.")
+        except websockets.exceptions.WebSocketException as e:
+            logger.error(f"WebSocket exception while sending audio: {e}")
+            raise
+        if stop:
+            logger.debug("Received stop signal for sending audio.")
+
+
+async def receive_messages(ws, events, aggregator, replay=None, tracker=None):
+    """
+    Receives transcription messages from the WebSocket and reports them as events.
+    Finalized segments are shown as they arrive; whole utterances are collected by the aggregator.
+    With MULTICHANNEL results are routed by channel: both sides are shown, only the caller's are answered.
+    """
+    final_ends = {}  # channel -> end of its last final result on the stream
+    while True:
+        try:
+            response = await ws.recv()
+            response_json = json.loads(response)
+            if response_json.get('type') == 'UtteranceEnd':
+                if not MULTICHANNEL or response_json.get('channel', [CALLER_CHANNEL])[0] == CALLER_CHANNEL:
+                    aggregator.utterance_end()
+            elif 'channel' in response_json and 'alternatives' in response_json['channel']:
+                transcription = response_json['channel']['alternatives'][0]['transcript']
+                is_final = response_json.get('is_final', False)
+                channel = response_json.get('channel_index', [0])[0]
+                from_caller = not MULTICHANNEL or channel == CALLER_CHANNEL
+                if is_final:
+                    stream_end = response_json['start'] + response_json['duration']
+                    final_ends[channel] = stream_end
+                    if replay is not None and len(final_ends) == CHANNELS:
+                        # Audio is only done once every channel has been finalized
+                        replay.ack(min(final_ends.values()))
+                    if tracker and transcription and from_caller:
+                        tracker.transcript_received(stream_end)
+                if transcription and is_final:
+                    # Reported before the aggregator can complete the utterance it belongs to
+                    label = f"{SPEAKER_LABELS[channel]}: " if MULTICHANNEL else ""
+                    events.write_event_value("-TRANSCRIPT-", label + transcription)
+                    logger.debug(f"Received transcription: {label}{transcription}")
+                if from_caller:
+                    aggregator.feed(transcription, is_final, response_json.get('speech_final', False))
+        except websockets.exceptions.WebSocketException as e:
+            logger.error(f"WebSocket exception while receiving messages: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Exception while receiving messages: {e}")
+            raise
+
+
+async def send_keep_alive(ws, state, keep_alive_interval=KEEP_ALIVE_INTERVAL):
+    """
+    Sends keep-alive messages to maintain the WebSocket connection.
+    Fires keep_alive_interval after the last audio, Deepgram closes idle connections after 10 seconds.
+    """
+    while True:
+        idle = time.time() - state['last_audio_time']
+        if idle < keep_alive_interval:
+            await asyncio.sleep(keep_alive_interval - idle)
+            continue
+        try:
+            await ws.send(json.dumps({"type": "KeepAlive"}))
+            logger.debug("Sent keep-alive message.")
+        except websockets.exceptions.WebSocketException as e:
+            logger.error(f"WebSocket exception while sending keep-alive: {e}")
+            raise
+        await asyncio.sleep(keep_alive_interval)
+
+
+class LoopAudioQueue:
+    """
+    Hands audio frames from the PyAudio callback thread straight to the event loop,
+    without a thread-pool hop per chunk. put() is thread-safe, get() is awaited on the loop.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def get_nowait(self):
+        return self.queue.get_nowait()
+
+
+async def gen_llm_answer(transcript: str, events, history: str, temperature: float = 0.7,
+                         answer_id=None, stream: bool = STREAM_ANSWERS, timeline=None) -> str:
+    """
+    Generates an answer for the transcript. In streaming mode every delta is reported
+    as a "-LLM_DELTA-" event tagged with answer_id; the full text always ends in "-LLM_ANSWER-".
+    Runs as an LLMWorkerPool job; cancelling the task stops the answer mid-stream.
+    Request, first and last token times are stamped into the timeline dict if one is given.
+    """
+    if timeline is None:
+        timeline = {}
+    system_prompt = SYSTEM_PROMPT
+
+    if history:
+        system_prompt += f"\nconversation history: \n {history}"
+
+    try:
+        timeline["llm_request"] = time.monotonic()
+        response = await openai.ChatCompletion.acreate(
+            model=LLM_MODEL,
+            temperature=temperature,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": transcript},
+            ],
+            stream=stream,
+        )
+        if stream:
+            parts = []
+            async for chunk in response:
+                delta = chunk["choices"][0]["delta"].get("content")
+                if delta:
+                    timeline.setdefault("first_token", time.monotonic())
+                    parts.append(delta)
+                    events.write_event_value("-LLM_DELTA-", (answer_id, delta))
+            rv = "".join(parts)
+        else:
+            rv = response["choices"][0]["message"]["content"]
+            timeline.setdefault("first_token", time.monotonic())
+        timeline["last_token"] = time.monotonic()
+    except Exception as error:
+        logger.error(f"Can't generate answer: {error}")
+        raise error
+
+    events.write_event_value("-LLM_ANSWER-", (answer_id, rv))
+
+    return rv
+
+
+def summarize_history(summary: str, turns: str) -> str:
+    """
+    Folds conversation turns into the running summary, used by ConversationHistory in a background thread.
+    """
+    response = openai.ChatCompletion.create(
+        model=LLM_MODEL,
+        temperature=0,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Existing summary:\n{summary or '-'}\n\nNew turns:\n{turns}"},
+        ],
+    )
+    return response["choices"][0]["message"]["content"]
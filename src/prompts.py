@@ -38,4 +38,10 @@ It’s just $79 for the diagnostic fee unless you are looking to replace your sy
 Last Line: 
 Thank you for the opportunity to earn your business, one of our agents will be in touch with you to confirm your appointment time.  
 
-"""
\ No newline at end of file
+"""
+SUMMARY_PROMPT = """
+You are summarizing a phone call between a customer (USER) and a sales agent (AI) for Avoca Air Conditioning.
+Merge the existing summary with the new conversation turns into one short summary.
+Keep every detail the agent has collected (problem, system age, name, address, callback number, email),
+what has been promised and what is still open. Write at most 120 words, no preamble.
+"""
@@ -0,0 +1,106 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+REPLAY_BUFFER_SEC = 10  # [sec]. audio kept for re-sending after a reconnect.
+
+
+class ReplayBuffer:
+    """
+    Keeps the audio sent over the current connection for up to `max_sec` seconds.
+
+    Offsets are counted in seconds of audio sent on the connection, which is the timeline Deepgram
+    reports results on, so ack() can drop everything already finalized. take() returns what is left
+    for the next connection.
+    """
+    def __init__(self, bytes_per_sec: int, max_sec: float = REPLAY_BUFFER_SEC):
+        self.bytes_per_sec = bytes_per_sec
+        self.max_sec = max_sec
+        self.chunks = collections.deque()  # [(sent at, stream end offset, audio)]
+        self.stream_bytes = 0
+
+    def append(self, audio: bytes):
+        self.stream_bytes += len(audio)
+        self.chunks.append((time.monotonic(), self.stream_bytes / self.bytes_per_sec, audio))
+        self._trim()
+
+    def ack(self, until_sec: float):
+        while self.chunks and self.chunks[0][1] <= until_sec:
+            self.chunks.popleft()
+
+    def take(self) -> list:
+        self._trim()
+        audio = [chunk for _, _, chunk in self.chunks]
+        self.chunks.clear()
+        self.stream_bytes = 0
+        return audio
+
+    def _trim(self):
+        deadline = time.monotonic() - self.max_sec
+        while self.chunks and self.chunks[0][0] < deadline:
+            self.chunks.popleft()
+
+
+class StandbyConnection:
+    """
+    Keeps a spare, idle connection open so failover doesn't wait for a TCP/TLS handshake.
+
+    `connect` is a coroutine function returning an open websocket. The spare only sends KeepAlive
+    messages until take() hands it over.
+    """
+    def __init__(self, connect, keep_alive_interval: float):
+        self.connect = connect
+        self.keep_alive_interval = keep_alive_interval
+        self._task = None
+        self._keep_alive = None
+
+    @property
+    def ready(self) -> bool:
+        return (self._task is not None and self._task.done() and not self._task.cancelled()
+                and self._task.exception() is None and not self._task.result().closed)
+
+    def warm(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._open())
+
+    async def take(self):
+        """
+        Returns the spare connection, waiting for it if it is still connecting, or None if there is none.
+        """
+        task, self._task = self._task, None
+        if task is None:
+            return None
+        try:
+            ws = await task
+        except Exception as e:
+            logger.error(f"Standby connection failed: {e}")
+            return None
+        self._keep_alive.cancel()
+        if ws.closed:
+            return None
+        return ws
+
+    async def close(self):
+        ws = await self.take()
+        if ws is not None:
+            await ws.close()
+
+    async def _open(self):
+        ws = await self.connect()
+        self._keep_alive = asyncio.create_task(self._send_keep_alive(ws))
+        logger.debug("Standby connection ready.")
+        return ws
+
+    async def _send_keep_alive(self, ws):
+        while True:
+            await asyncio.sleep(self.keep_alive_interval)
+            try:
+                await ws.send(json.dumps({"type": "KeepAlive"}))
+            except Exception as e:
+                # take() sees the closed connection and skips it
+                logger.error(f"Standby connection lost: {e}")
+                return
@@ -0,0 +1,71 @@
+import logging
+
+from src.answer_cache import similarity
+
+logger = logging.getLogger(__name__)
+
+SPECULATION_MIN_WORDS = 4  # interim text needs this many words before an answer is speculated.
+SPECULATION_MATCH_THRESHOLD = 0.8  # similarity between speculated and final text to use the answer.
+
+
+class Speculator:
+    """
+    Tracks the answer speculatively started from an interim transcript.
+
+    A new speculation replaces the current one only once the interim text has drifted below the match
+    threshold, counted in `restarts`. resolve() compares the final utterance with the speculated text,
+    `hits` and `misses` only count that comparison.
+    """
+    def __init__(self, min_words: int = SPECULATION_MIN_WORDS, threshold: float = SPECULATION_MATCH_THRESHOLD):
+        self.min_words = min_words
+        self.threshold = threshold
+        self.answer_id = None
+        self.text = None
+        self.hits = 0
+        self.misses = 0
+        self.restarts = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def should_start(self, text: str) -> bool:
+        if len(text.split()) < self.min_words:
+            return False
+        return self.text is None or similarity(text, self.text) < self.threshold
+
+    def start(self, answer_id, text: str):
+        """
+        Records a new speculation, returns the id of the one it replaces (to be cancelled) or None.
+        """
+        replaced = self.answer_id
+        self.answer_id, self.text = answer_id, text
+        if replaced is not None:
+            self.restarts += 1
+        return replaced
+
+    def resolve(self, utterance: str):
+        """
+        Returns (answer id, matched) for the pending speculation, or (None, False) if there is none.
+        """
+        answer_id, text = self.answer_id, self.text
+        self.answer_id = self.text = None
+        if answer_id is None:
+            return None, False
+        matched = similarity(utterance, text) >= self.threshold
+        if matched:
+            self.hits += 1
+        else:
+            self.misses += 1
+        logger.debug(f"Speculation {'hit' if matched else 'miss'}, hits: {self.hits}, misses: {self.misses}, "
+                     f"restarts: {self.restarts}.")
+        return answer_id, matched
+
+    def discard(self):
+        """
+        Drops the pending speculation without counting it, returns its id or None.
+        """
+        answer_id = self.answer_id
+        self.answer_id = self.text = None
+        return answer_id
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+UTTERANCE_SILENCE_SEC = 1.0  # [sec]. flush pending speech after this much silence.
+# [sec]. wait after Deepgram's speech_final for the caller to go on. Its endpointing is short so a breath
+# mid-question doesn't split it in two; longer waits cost the same time on every answer.
+UTTERANCE_ENDPOINT_SEC = 0.5
+
+
+class UtteranceAggregator:
+    """
+    Joins finalized Deepgram segments into whole utterances.
+
+    An utterance is emitted on Deepgram's UtteranceEnd, `endpoint_sec` after it flags `speech_final`,
+    or when finalized text has been waiting for `silence_sec`, in each case only if no new speech came.
+    `on_partial`, if given, receives the utterance so far (final segments plus the interim result)
+    while the caller is still speaking. Must be used from inside the running event loop.
+    """
+    def __init__(self, on_utterance, silence_sec: float = UTTERANCE_SILENCE_SEC, on_partial=None,
+                 endpoint_sec: float = UTTERANCE_ENDPOINT_SEC):
+        self.on_utterance = on_utterance
+        self.on_partial = on_partial
+        self.silence_sec = silence_sec
+        self.endpoint_sec = endpoint_sec
+        self.segments = []
+        self._timer = None
+
+    def feed(self, transcript: str, is_final: bool, speech_final: bool):
+        if transcript:
+            # The caller is still talking, postpone the silence flush
+            self._cancel_timer()
+        if is_final and transcript:
+            self.segments.append(transcript)
+        if transcript and self.on_partial is not None:
+            self.on_partial(" ".join(self.segments if is_final else self.segments + [transcript]))
+        if self.segments and (speech_final or self._timer is None):
+            # New words cancel the flush again, see above
+            self._cancel_timer()
+            delay = self.endpoint_sec if speech_final else self.silence_sec
+            self._timer = asyncio.get_running_loop().call_later(delay, self.flush)
+
+    def utterance_end(self):
+        self.flush()
+
+    def flush(self):
+        self._cancel_timer()
+        if not self.segments:
+            return
+        utterance = " ".join(self.segments)
+        self.segments = []
+        logger.debug(f"Utterance complete: {utterance}")
+        self.on_utterance(utterance)
+
+    def close(self):
+        """
+        Drops pending speech without emitting it, e.g. when the call ends.
+        """
+        self._cancel_timer()
+        self.segments = []
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -0,0 +1,95 @@
+import collections
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VAD_FRAME_MS = 20  # [ms]. analysis frame.
+VAD_ENERGY_DBFS = -45.0  # [dBFS]. frames louder than this are voiced speech.
+VAD_UNVOICED_MARGIN_DB = 10.0  # [dB]. quieter frames still count as speech if they have a high zero-crossing rate.
+VAD_ZCR_THRESHOLD = 0.25  # zero crossings per sample typical for fricatives ("s", "f", "sh").
+VAD_NOISE_MARGIN_DB = 6.0  # [dB]. speech must also be this much louder than the tracked noise floor.
+VAD_FLOOR_RISE_DB_PER_SEC = 3.0  # [dB/sec]. how fast the noise floor follows louder background noise.
+VAD_HANGOVER_MS = 500  # [ms]. audio kept after speech, longer than Deepgram's endpointing so it sees the pause.
+VAD_PREROLL_MS = 200  # [ms]. audio kept before speech so word onsets aren't clipped.
+
+
+class VoiceActivityDetector:
+    """
+    Energy and zero-crossing voice activity detector for int16 PCM.
+
+    process() takes buffers of any size and returns only the audio worth sending: speech frames,
+    `preroll_ms` before each speech onset and `hangover_ms` after it. Silence comes back as b"".
+    Multichannel audio is mixed down for the decision, the returned bytes keep every channel.
+    Besides the absolute levels, speech has to stand out from a running noise floor: it drops to quieter
+    frames at once and rises by `floor_rise_db_per_sec` only, so steady hiss or hum closes the gate.
+    """
+    def __init__(self, rate: int, channels: int = 1, frame_ms: int = VAD_FRAME_MS,
+                 energy_dbfs: float = VAD_ENERGY_DBFS, zcr_threshold: float = VAD_ZCR_THRESHOLD,
+                 hangover_ms: int = VAD_HANGOVER_MS, preroll_ms: int = VAD_PREROLL_MS,
+                 noise_margin_db: float = VAD_NOISE_MARGIN_DB,
+                 floor_rise_db_per_sec: float = VAD_FLOOR_RISE_DB_PER_SEC):
+        self.channels = channels
+        self.frame_bytes = rate * frame_ms // 1000 * 2 * channels
+        self.energy_dbfs = energy_dbfs
+        self.zcr_threshold = zcr_threshold
+        self.noise_margin_db = noise_margin_db
+        self.floor_rise = floor_rise_db_per_sec * frame_ms / 1000  # [dB] per frame
+        self.noise_floor = energy_dbfs
+        self.hangover_frames = hangover_ms // frame_ms
+        self.hangover = 0
+        self.preroll = collections.deque(maxlen=preroll_ms // frame_ms)
+        self.remainder = b""
+        self.dropped_bytes = 0
+
+    @property
+    def in_speech(self) -> bool:
+        return self.hangover > 0
+
+    def speech_mask(self, frames: np.ndarray) -> np.ndarray:
+        """
+        Speech decision for every row of a (n_frames, frame_len) int16 array.
+        """
+        x = frames.astype(np.float32) / 32768.0
+        energy_db = 10 * np.log10(np.mean(x * x, axis=1) + 1e-10)
+        zcr = np.mean(np.signbit(x[:, 1:]) != np.signbit(x[:, :-1]), axis=1)
+
+        # Running floor f[i] = min(e[i], f[i-1] + rise), unrolled into a cumulative minimum
+        steps = np.arange(len(energy_db)) * self.floor_rise
+        floor = steps + np.minimum(self.noise_floor + self.floor_rise, np.minimum.accumulate(energy_db - steps))
+        self.noise_floor = floor[-1]
+
+        above_noise = energy_db >= floor + self.noise_margin_db
+        voiced = energy_db >= self.energy_dbfs
+        unvoiced = (energy_db >= self.energy_dbfs - VAD_UNVOICED_MARGIN_DB) & (zcr >= self.zcr_threshold)
+        return above_noise & (voiced | unvoiced)
+
+    def process(self, audio: bytes) -> bytes:
+        data = self.remainder + audio
+        n_frames = len(data) // self.frame_bytes
+        self.remainder = data[n_frames * self.frame_bytes:]
+        if not n_frames:
+            return b""
+
+        samples = np.frombuffer(data, dtype=np.int16, count=n_frames * self.frame_bytes // 2)
+        frames = samples.reshape(n_frames, -1, self.channels).mean(axis=2)
+        mask = self.speech_mask(frames)
+
+        out = []
+        for i, is_speech in enumerate(mask):
+            frame = data[i * self.frame_bytes:(i + 1) * self.frame_bytes]
+            if is_speech:
+                if not self.hangover:
+                    out.extend(self.preroll)
+                    self.preroll.clear()
+                self.hangover = self.hangover_frames
+                out.append(frame)
+            elif self.hangover:
+                self.hangover -= 1
+                out.append(frame)
+            else:
+                if len(self.preroll) == self.preroll.maxlen:
+                    self.dropped_bytes += self.frame_bytes
+                self.preroll.append(frame)
+        return b"".join(out)